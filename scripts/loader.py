@@ -1,15 +1,24 @@
 #######
 #
-# usage: python3 loader.py [absolute_path_to_records]
+# usage: python3 loader.py [absolute_path_to_records] [optional_cache_directory]
+#
+# requires: pip install httpx orjson
 #
 #######
 
-import json, os, glob, requests, csv, sys
+import os, io, csv, sys, atexit, asyncio, hashlib, tempfile, httpx, orjson
+
+# Wrapper responses can optionally be cached by request body so reruns over the
+# same input don't need to re-send it. This is off by default, since a cached
+# response does not reflect changes made to the wrapper since it was stored.
+cacheDirectory = os.path.abspath(sys.argv[2]) if len(sys.argv) > 2 else None
+if cacheDirectory:
+  os.makedirs(cacheDirectory, exist_ok=True)
 
 # List the directory of the records and retrieve only the .json files from that directory
 recordDirectory = sys.argv[1]
 os.chdir(recordDirectory)
-records = glob.glob('*.json')
+records = sorted(entry.name for entry in os.scandir('.') if entry.is_file() and entry.name.endswith('.json'))
 resultsDirectory = "results"
 
 # Create the FHIR Parameters resource
@@ -20,23 +29,120 @@ parameter = {"resource":
  "id": "0",
  "parameter": [{"name": "zipCode", "valueString":zipCode}]}}
 
-# Loop through each record
-for record in records:
-  print(record)
-  with open(record) as f:
-    data = json.load(f)
-
-    # Add the parameter resource to the record
-    data["entry"].append(parameter)
-    data["type"] = "collection"
-
-    # Send the patient bundle to the wrapper
-    response = requests.post('http://localhost:3000/getClinicalTrial', data=json.dumps(data), headers={"Content-Type":"application/json"})
-    researchStudies = response.json()
-
-    # Create a .csv file in the resultsDirectory and write the NCTID of each match to that file 
-    if (researchStudies["total"] > 0):
-      with open(resultsDirectory + "/" + record[:-5] + ".csv", mode='w') as result_file:
-        writer = csv.writer(result_file)
-        for entry in researchStudies["entry"]:
-          writer.writerow([entry["resource"]["id"]])
+# The Parameters resource is the same for every record, so only serialize it once
+parameterJson = orjson.dumps(parameter)
+
+# Number of requests to have in flight against the wrapper at once
+maxConnections = 16
+
+# Progress output is flushed every progressInterval records (and whenever an
+# error is logged) rather than after every line when stdout is redirected
+progressInterval = 100
+completedRuns = 0
+
+# Errors raised by individual records in this run are written (and flushed) to a
+# JSON-lines file as they happen, so they survive the run being interrupted
+os.makedirs(resultsDirectory, exist_ok=True)
+errorFile = open(resultsDirectory + "/errors.jsonl", 'w')
+atexit.register(errorFile.close)
+errorCount = 0
+
+def split_record(bundle):
+  # Serialize the record as a collection with "entry" last, and split it just
+  # before the closing "]}" of the entry array so the Parameters resource can
+  # be spliced in without re-serializing the record
+  if not isinstance(bundle, dict) or not isinstance(bundle.get("entry"), list):
+    raise ValueError("record is not a Bundle with an entry array")
+  body = {key: value for key, value in bundle.items() if key not in ("type", "entry")}
+  body["type"] = "collection"
+  body["entry"] = bundle["entry"]
+  text = orjson.dumps(body)
+  separator = b"," if bundle["entry"] else b""
+  return (text[:-2] + separator, text[-2:])
+
+# The helpers below do blocking file I/O and JSON work, and are run on worker
+# threads so that a large bundle doesn't stall every other in-flight request
+
+def load_record(record):
+  # Add the parameter resource to the record
+  with open(record, 'rb') as f:
+    prefix, suffix = split_record(orjson.loads(f.read()))
+  return prefix + parameterJson + suffix
+
+def read_cache(cachePath):
+  if not os.path.exists(cachePath):
+    return None
+  with open(cachePath, 'rb') as f:
+    return orjson.loads(f.read())
+
+def write_cache(cachePath, content):
+  # Write to a temporary file first so an interrupted run never leaves a
+  # truncated response in the cache
+  fd, tempPath = tempfile.mkstemp(dir=cacheDirectory, suffix=".tmp")
+  try:
+    with os.fdopen(fd, 'wb') as f:
+      f.write(content)
+    os.replace(tempPath, cachePath)
+  except BaseException:
+    os.unlink(tempPath)
+    raise
+
+def write_results(record, researchStudies):
+  # Create a .csv file in the resultsDirectory and write the NCTID of each match to that file
+  if (researchStudies["total"] > 0):
+    fileName = resultsDirectory + "/" + record[:-5] + ".csv"
+    rows = [[entry["resource"]["id"]] for entry in researchStudies["entry"]]
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    with open(fileName, mode='w', newline='', buffering=1<<16) as result_file:
+      result_file.write(buffer.getvalue())
+
+async def send_record(client, record):
+  body = await asyncio.to_thread(load_record, record)
+
+  # Send the patient bundle to the wrapper, unless the response is already cached
+  cachePath = None
+  researchStudies = None
+  if cacheDirectory:
+    cachePath = cacheDirectory + "/" + hashlib.blake2b(body, digest_size=16).hexdigest() + ".json"
+    researchStudies = await asyncio.to_thread(read_cache, cachePath)
+  if researchStudies is None:
+    response = await client.post('/getClinicalTrial', content=body, headers={"Content-Type":"application/json"})
+    response.raise_for_status()
+    researchStudies = orjson.loads(response.content)
+    if not isinstance(researchStudies, dict) or not isinstance(researchStudies.get("total"), int):
+      raise ValueError("wrapper response is not a Bundle with a total")
+    if cachePath:
+      await asyncio.to_thread(write_cache, cachePath, response.content)
+  await asyncio.to_thread(write_results, record, researchStudies)
+
+async def run_one(client, semaphore, record):
+  global completedRuns, errorCount
+  # Records are only read once a slot is free, so at most maxConnections
+  # bundles are held in memory at a time
+  async with semaphore:
+    try:
+      await send_record(client, record)
+      failed = False
+    except Exception as e:
+      errorFile.write(orjson.dumps({"record": record, "error": repr(e)}).decode() + "\n")
+      errorFile.flush()
+      errorCount += 1
+      failed = True
+    completedRuns += 1
+    sys.stdout.write(f"Record ({completedRuns}/{len(records)}): {record}" + (" (failed)" if failed else "") + "\n")
+    if failed or completedRuns % progressInterval == 0:
+      sys.stdout.flush()
+
+async def main():
+  semaphore = asyncio.Semaphore(maxConnections)
+  limits = httpx.Limits(max_connections=maxConnections, max_keepalive_connections=maxConnections)
+  async with httpx.AsyncClient(base_url='http://localhost:3000', timeout=30, limits=limits) as client:
+    tasks = [asyncio.create_task(run_one(client, semaphore, record)) for record in records]
+    await asyncio.gather(*tasks)
+
+asyncio.run(main())
+
+if errorCount:
+  print("Failed to load " + str(errorCount) + " record(s), see " + errorFile.name)
+  sys.exit(1)